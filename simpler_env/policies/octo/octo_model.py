@@ -1,16 +1,48 @@
-from collections import deque
 from typing import Optional, Sequence
 import os
 
 import jax
 import matplotlib.pyplot as plt
+from numba import njit
 import numpy as np
 from octo.model.octo_model import OctoModel
-import tensorflow as tf
 from transformers import AutoTokenizer
-from transforms3d.euler import euler2axangle
 
 from simpler_env.utils.action.action_ensemble import ActionEnsembler
+from simpler_env.utils.action.rotation import euler2axangle_fast
+from simpler_env.utils.image_resize import ImageResizer
+
+_euler2axangle_fast = njit(cache=True, fastmath=True)(euler2axangle_fast)
+
+
+@njit(cache=True, fastmath=True)
+def _postprocess_action(raw_action, action_scale):
+    """
+    Input:
+        raw_action: np.ndarray of shape (7,), float64; denormalized (and ensembled) policy action
+        action_scale: float
+    Output:
+        world_vector, rot_axangle: np.ndarray of shape (3,); scaled actions to be sent to the maniskill2 environment
+        binarized_gripper: np.ndarray of shape (1,); 1 (open) or -1 (close), as used by widowx_bridge
+        raw_world_vector, raw_rotation_delta, raw_open_gripper: views of the raw action components
+    """
+    raw_world_vector = raw_action[:3]
+    raw_rotation_delta = raw_action[3:6]
+    raw_open_gripper = raw_action[6:7]
+
+    world_vector = raw_world_vector * action_scale
+
+    rotation_ax, rotation_angle = _euler2axangle_fast(raw_action[3], raw_action[4], raw_action[5])
+    rot_axangle = rotation_ax * rotation_angle * action_scale
+
+    binarized_gripper = np.empty(1)
+    binarized_gripper[0] = 1.0 if raw_action[6] > 0.5 else -1.0
+
+    return world_vector, rot_axangle, binarized_gripper, raw_world_vector, raw_rotation_delta, raw_open_gripper
+
+
+# compile at import time, so that the first policy step does not pay for it
+_postprocess_action(np.zeros(7), 1.0)
 
 
 class OctoInference:
@@ -26,6 +58,7 @@ class OctoInference:
         image_size: int = 256,
         action_scale: float = 1.0,
         init_rng: int = 0,
+        tf_compatible_resize: bool = True,
     ) -> None:
         os.environ["TOKENIZERS_PARALLELISM"] = "false"
         if policy_setup == "widowx_bridge":
@@ -41,6 +74,8 @@ class OctoInference:
         else:
             raise NotImplementedError(f"Policy setup {policy_setup} not supported for octo models.")
         self.policy_setup = policy_setup
+        # checked on every step; the policy setup is validated above, so anything else is widowx_bridge
+        self._is_google_robot = policy_setup == "google_robot"
         self.dataset_id = dataset_id
 
         if model is not None:
@@ -57,8 +92,16 @@ class OctoInference:
             self.action_std = self.model.dataset_statistics[dataset_id]["action"]["std"]
         else:
             raise NotImplementedError()
+        # float64, so that actions are denormalized in place on the host copy of the model output in step()
+        self.action_mean = np.asarray(self.action_mean, dtype=np.float64)
+        self.action_std = np.asarray(self.action_std, dtype=np.float64)
 
         self.image_size = image_size
+        self._resizer = ImageResizer(image_size, tf_compatible=tf_compatible_resize)
+        # released octo models take uint8 images; for a model that takes float images, the resized image is passed on
+        # without rounding it to uint8 first
+        self._image_dtype = np.dtype(self.model.example_batch["observation"]["image_primary"].dtype)
+        self._quantize_image = self._image_dtype == np.uint8
         self.action_scale = action_scale
         self.horizon = horizon
         self.pred_action_horizon = pred_action_horizon
@@ -70,62 +113,94 @@ class OctoInference:
             # the purpose of this for loop is just to match octo server's inference seeds
             self.rng, _key = jax.random.split(self.rng)  # each shape [2,]
 
-        self.sticky_action_is_on = False
-        self.gripper_action_repeat = 0
-        self.sticky_gripper_action = 0.0
-        # self.gripper_is_closed = False
-        self.previous_gripper_action = None
-
         self.task = None
         self.task_description = None
-        self.image_history = deque(maxlen=self.horizon)
-        if self.action_ensemble:
-            self.action_ensembler = ActionEnsembler(self.pred_action_horizon, self.action_ensemble_temp)
-        else:
-            self.action_ensembler = None
+        # evaluation repeats the same few instructions across episodes; tokenize each of them only once
+        self._task_cache = {}  # (task description, batch size) -> tasks created by self.model.create_tasks
+        # model input reused across steps; its entries are replaced in step_batch()
+        self._input_observation = {"image_primary": None, "pad_mask": None}
+        # number of environments stepped together by step_batch(); step() uses a batch of 1
+        self.batch_size = 1
+        self._init_batch_state()
         self.num_image_history = 0
+        self._vis_fig, self._vis_axs = None, None  # figure reused across visualize_epoch calls
 
-    def _resize_image(self, image: np.ndarray) -> np.ndarray:
-        image = tf.image.resize(
-            image,
-            size=(self.image_size, self.image_size),
-            method="lanczos3",
-            antialias=True,
+        self._warmup_sample_actions()
+
+    def _init_batch_state(self) -> None:
+        """(Re)allocate the per-environment policy state for self.batch_size environments."""
+        # preallocated history of the last `horizon` resized images of each environment, oldest first;
+        # it is passed to the model as is, shape (batch_size, horizon, image_size, image_size, 3)
+        self._image_buf = np.empty(
+            (self.batch_size, self.horizon, self.image_size, self.image_size, 3), dtype=self._image_dtype
         )
-        image = tf.cast(tf.clip_by_value(tf.round(image), 0, 255), tf.uint8).numpy()
-        return image
-
-    def _add_image_to_history(self, image: np.ndarray) -> None:
-        self.image_history.append(image)
-        # Alternative implementation below; but looks like for real eval, filling the entire buffer at the first step is not necessary
-        # if self.num_image_history == 0:
-        #     self.image_history.extend([image] * self.horizon)
-        # else:
-        #     self.image_history.append(image)
+        # self._pad_masks[n] is the (batch_size, horizon) pad mask after n images have been observed
+        # note: this should be of float type, not a bool type
+        pad_masks = np.arange(self.horizon)[None] >= self.horizon - np.arange(self.horizon + 1)[:, None]
+        pad_masks = np.broadcast_to(pad_masks[:, None], (self.horizon + 1, self.batch_size, self.horizon))
+        self._pad_masks = np.ascontiguousarray(pad_masks, dtype=np.float64)
+        if self.action_ensemble:
+            self._action_ensemblers = [
+                ActionEnsembler(self.pred_action_horizon, self.action_ensemble_temp) for _ in range(self.batch_size)
+            ]
+        else:
+            self._action_ensemblers = None
+        self._reset_gripper_state()
+
+    def _reset_gripper_state(self) -> None:
+        # sticky gripper state of each environment, indexed by env id
+        self._sticky_action_is_on = [False] * self.batch_size
+        self._gripper_action_repeat = [0] * self.batch_size
+        self._sticky_gripper_action = [0.0] * self.batch_size
+        # self._gripper_is_closed = [False] * self.batch_size
+        self._previous_gripper_action = [None] * self.batch_size
+
+    def _warmup_sample_actions(self) -> None:
+        """
+        Trace and compile the (already jitted) self.model.sample_actions for the fixed input shapes of step(), so that
+        the first step of the first episode does not pay for it. Uses its own rng key, so that self.rng is left
+        untouched.
+        """
+        input_observation = {"image_primary": np.zeros_like(self._image_buf), "pad_mask": self._pad_masks[self.horizon]}
+        tasks = self.model.create_tasks(texts=[""] * self.batch_size)
+        norm_raw_actions = self.model.sample_actions(input_observation, tasks, rng=jax.random.PRNGKey(0))
+        jax.block_until_ready(norm_raw_actions)
+
+    def _add_images_to_history(self, images: np.ndarray) -> None:
+        # images: (batch_size, image_size, image_size, 3), the newest image of each environment
+        # fill the entire buffer at the first step, so that the model input has the same shape at every step;
+        # the padded images are masked out through pad_mask
+        if self.num_image_history == 0:
+            self._image_buf[:] = images[:, None]
+        else:
+            # shift the history by one image and append the new one; this copies as much as gathering a ring buffer
+            # in order would, but keeps the buffer contiguous and ready to be passed to the model
+            self._image_buf[:, :-1] = self._image_buf[:, 1:]
+            self._image_buf[:, -1] = images
         self.num_image_history = min(self.num_image_history + 1, self.horizon)
 
     def _obtain_image_history_and_mask(self) -> tuple[np.ndarray, np.ndarray]:
-        images = np.stack(self.image_history, axis=0)
-        horizon = len(self.image_history)
-        pad_mask = np.ones(horizon, dtype=np.float64)  # note: this should be of float type, not a bool type
-        pad_mask[: horizon - min(horizon, self.num_image_history)] = 0
-        # pad_mask = np.ones(self.horizon, dtype=np.float64) # note: this should be of float type, not a bool type
-        # pad_mask[:self.horizon - self.num_image_history] = 0
-        return images, pad_mask
-
-    def reset(self, task_description: str) -> None:
-        self.task = self.model.create_tasks(texts=[task_description])
+        return self._image_buf, self._pad_masks[self.num_image_history]
+
+    def reset(self, task_description: str, batch_size: Optional[int] = None) -> None:
+        """
+        Reset the policy state for a new episode; batch_size optionally changes the number of environments stepped
+        together by step_batch(), which all share the same task description.
+        """
+        if batch_size is not None and batch_size != self.batch_size:
+            self.batch_size = batch_size
+            self._init_batch_state()
+        task_key = (task_description, self.batch_size)
+        if task_key not in self._task_cache:
+            self._task_cache[task_key] = self.model.create_tasks(texts=[task_description] * self.batch_size)
+        self.task = self._task_cache[task_key]
         self.task_description = task_description
-        self.image_history.clear()
         if self.action_ensemble:
-            self.action_ensembler.reset()
+            for action_ensembler in self._action_ensemblers:
+                action_ensembler.reset()
         self.num_image_history = 0
 
-        self.sticky_action_is_on = False
-        self.gripper_action_repeat = 0
-        self.sticky_gripper_action = 0.0
-        # self.gripper_is_closed = False
-        self.previous_gripper_action = None
+        self._reset_gripper_state()
 
     def step(self, image: np.ndarray, task_description: Optional[str] = None, *args, **kwargs) -> tuple[dict[str, np.ndarray], dict[str, np.ndarray]]:
         """
@@ -140,51 +215,84 @@ class OctoInference:
                 - 'gripper': np.ndarray of shape (1,), gripper action
                 - 'terminate_episode': np.ndarray of shape (1,), 1 if episode should be terminated, 0 otherwise
         """
-        if task_description is not None:
-            if task_description != self.task_description:
-                # task description has changed; reset the policy state
-                self.reset(task_description)
-
         assert image.dtype == np.uint8
-        image = self._resize_image(image)
-        self._add_image_to_history(image)
-        images, pad_mask = self._obtain_image_history_and_mask()
-        images, pad_mask = images[None], pad_mask[None]
+        image = self._resizer.resize(image, quantize=self._quantize_image)
+        return self._step_resized_batch(image[None], task_description)[0]
+
+    def step_batch(
+        self, images: np.ndarray, task_description: Optional[str] = None
+    ) -> list[tuple[dict[str, np.ndarray], dict[str, np.ndarray]]]:
+        """
+        Step a batch of environments that share the same task with a single model forward pass.
+        Input:
+            images: np.ndarray of shape (N, H, W, 3), uint8; current image of each environment
+            task_description: Optional[str], task description; if different from previous task description, or if the
+                number of environments changes, policy state is reset
+        Output:
+            list of N (raw_action, action) tuples, one per environment, in the same format as returned by step()
+        """
+        assert images.dtype == np.uint8
+        images = self._resizer.resize_batch(images, quantize=self._quantize_image)
+        return self._step_resized_batch(images, task_description)
+
+    def _step_resized_batch(
+        self, images: np.ndarray, task_description: Optional[str]
+    ) -> list[tuple[dict[str, np.ndarray], dict[str, np.ndarray]]]:
+        if task_description is None:
+            task_description = self.task_description
+        if task_description != self.task_description or len(images) != self.batch_size:
+            # task description or number of environments has changed; reset the policy state
+            self.reset(task_description, batch_size=len(images))
+
+        self._add_images_to_history(images)
+        images, pad_mask = self._obtain_image_history_and_mask()  # both with a batch axis of size batch_size
 
         # we need use a different rng key for each model forward step; this has a large impact on model performance
         self.rng, key = jax.random.split(self.rng)  # each shape [2,]
         # print("octo local rng", self.rng, key)
 
-        input_observation = {"image_primary": images, "pad_mask": pad_mask}
-        norm_raw_actions = self.model.sample_actions(
-            input_observation,
-            self.task,
-            rng=key,
-        )
-        raw_actions = norm_raw_actions * self.action_std[None] + self.action_mean[None]
-        raw_actions = raw_actions[0]  # remove batch, becoming (action_pred_horizon, action_dim)
-
-        assert raw_actions.shape == (self.pred_action_horizon, 7)
+        self._input_observation["image_primary"] = images
+        self._input_observation["pad_mask"] = pad_mask
+        # the model inputs have the same shapes at every step, so this reuses the program compiled at warmup
+        # (or, for a new batch size, at the first step)
+        norm_raw_actions = self.model.sample_actions(self._input_observation, self.task, rng=key)
+        # copy to host once, becoming (batch_size, action_pred_horizon, action_dim); then denormalize in place
+        batch_raw_actions = np.array(norm_raw_actions, dtype=np.float64)
+        batch_raw_actions *= self.action_std
+        batch_raw_actions += self.action_mean
+        assert batch_raw_actions.shape == (self.batch_size, self.pred_action_horizon, 7)
+
+        return [
+            self._postprocess_env_action(env_id, raw_actions) for env_id, raw_actions in enumerate(batch_raw_actions)
+        ]
+
+    def _postprocess_env_action(
+        self, env_id: int, raw_actions: np.ndarray
+    ) -> tuple[dict[str, np.ndarray], dict[str, np.ndarray]]:
         if self.action_ensemble:
-            raw_actions = self.action_ensembler.ensemble_action(raw_actions)
+            raw_actions = self._action_ensemblers[env_id].ensemble_action(raw_actions)
             raw_actions = raw_actions[None]  # [1, 7]
 
+        # process raw_action to obtain the action to be sent to the maniskill2 environment;
+        # raw_actions is a new array on every step, so the raw action components are returned as views into it
+        (
+            world_vector,
+            rot_axangle,
+            binarized_gripper,
+            raw_world_vector,
+            raw_rotation_delta,
+            raw_open_gripper,
+        ) = _postprocess_action(raw_actions[0], float(self.action_scale))
         raw_action = {
-            "world_vector": np.array(raw_actions[0, :3]),
-            "rotation_delta": np.array(raw_actions[0, 3:6]),
-            "open_gripper": np.array(raw_actions[0, 6:7]),  # range [0, 1]; 1 = open; 0 = close
+            "world_vector": raw_world_vector,
+            "rotation_delta": raw_rotation_delta,
+            "open_gripper": raw_open_gripper,  # range [0, 1]; 1 = open; 0 = close
         }
-
-        # process raw_action to obtain the action to be sent to the maniskill2 environment
         action = {}
-        action["world_vector"] = raw_action["world_vector"] * self.action_scale
-        action_rotation_delta = np.asarray(raw_action["rotation_delta"], dtype=np.float64)
-        roll, pitch, yaw = action_rotation_delta
-        action_rotation_ax, action_rotation_angle = euler2axangle(roll, pitch, yaw)
-        action_rotation_axangle = action_rotation_ax * action_rotation_angle
-        action["rot_axangle"] = action_rotation_axangle * self.action_scale
-
-        if self.policy_setup == "google_robot":
+        action["world_vector"] = world_vector
+        action["rot_axangle"] = rot_axangle
+
+        if self._is_google_robot:
             current_gripper_action = raw_action["open_gripper"]
 
             # This is one of the ways to implement gripper actions; we use an alternative implementation below for consistency with real
@@ -208,33 +316,31 @@ class OctoInference:
             # action['gripper'] = np.array([relative_gripper_action])
 
             # alternative implementation
-            if self.previous_gripper_action is None:
+            if self._previous_gripper_action[env_id] is None:
                 relative_gripper_action = np.array([0])
             else:
                 relative_gripper_action = (
-                    self.previous_gripper_action - current_gripper_action
+                    self._previous_gripper_action[env_id] - current_gripper_action
                 )  # google robot 1 = close; -1 = open
-            self.previous_gripper_action = current_gripper_action
+            self._previous_gripper_action[env_id] = current_gripper_action
 
-            if np.abs(relative_gripper_action) > 0.5 and self.sticky_action_is_on is False:
-                self.sticky_action_is_on = True
-                self.sticky_gripper_action = relative_gripper_action
+            if np.abs(relative_gripper_action) > 0.5 and self._sticky_action_is_on[env_id] is False:
+                self._sticky_action_is_on[env_id] = True
+                self._sticky_gripper_action[env_id] = relative_gripper_action
 
-            if self.sticky_action_is_on:
-                self.gripper_action_repeat += 1
-                relative_gripper_action = self.sticky_gripper_action
+            if self._sticky_action_is_on[env_id]:
+                self._gripper_action_repeat[env_id] += 1
+                relative_gripper_action = self._sticky_gripper_action[env_id]
 
-            if self.gripper_action_repeat == self.sticky_gripper_num_repeat:
-                self.sticky_action_is_on = False
-                self.gripper_action_repeat = 0
-                self.sticky_gripper_action = 0.0
+            if self._gripper_action_repeat[env_id] == self.sticky_gripper_num_repeat:
+                self._sticky_action_is_on[env_id] = False
+                self._gripper_action_repeat[env_id] = 0
+                self._sticky_gripper_action[env_id] = 0.0
 
             action["gripper"] = relative_gripper_action
 
-        elif self.policy_setup == "widowx_bridge":
-            action["gripper"] = (
-                2.0 * (raw_action["open_gripper"] > 0.5) - 1.0
-            )  # binarize gripper action to 1 (open) and -1 (close)
+        else:
+            action["gripper"] = binarized_gripper  # binarize gripper action to 1 (open) and -1 (close)
             # self.gripper_is_closed = (action['gripper'] < 0.0)
 
         action["terminate_episode"] = np.array([0.0])
@@ -242,24 +348,29 @@ class OctoInference:
         return raw_action, action
 
     def visualize_epoch(self, predicted_raw_actions: Sequence[np.ndarray], images: Sequence[np.ndarray], save_path: str) -> None:
-        images = [self._resize_image(image) for image in images]
+        # only every third image is shown in the image strip
+        images = self._resizer.resize_batch(images[::3])
         ACTION_DIM_LABELS = ["x", "y", "z", "roll", "pitch", "yaw", "grasp"]
 
-        img_strip = np.concatenate(np.array(images[::3]), axis=1)
+        img_strip = np.concatenate(images, axis=1)
 
-        # set up plt figure
-        figure_layout = [["image"] * len(ACTION_DIM_LABELS), ACTION_DIM_LABELS]
-        plt.rcParams.update({"font.size": 12})
-        fig, axs = plt.subplot_mosaic(figure_layout)
-        fig.set_size_inches([45, 10])
+        # set up plt figure; it is created once and cleared on later calls, as this is called after every episode
+        if self._vis_fig is None:
+            figure_layout = [["image"] * len(ACTION_DIM_LABELS), ACTION_DIM_LABELS]
+            plt.rcParams.update({"font.size": 12})
+            self._vis_fig, self._vis_axs = plt.subplot_mosaic(figure_layout)
+            self._vis_fig.set_size_inches([45, 10])
+        else:
+            for ax in self._vis_axs.values():
+                ax.clear()
+        fig, axs = self._vis_fig, self._vis_axs
 
         # plot actions
-        pred_actions = np.array(
-            [
-                np.concatenate([a["world_vector"], a["rotation_delta"], a["open_gripper"]], axis=-1)
-                for a in predicted_raw_actions
-            ]
-        )
+        pred_actions = np.empty((len(predicted_raw_actions), len(ACTION_DIM_LABELS)), dtype=np.float32)
+        for i, a in enumerate(predicted_raw_actions):
+            pred_actions[i, :3] = a["world_vector"]
+            pred_actions[i, 3:6] = a["rotation_delta"]
+            pred_actions[i, 6:] = a["open_gripper"]
         for action_dim, action_label in enumerate(ACTION_DIM_LABELS):
             # actions have batch, horizon, dim, in this example we just take the first action for simplicity
             axs[action_label].plot(pred_actions[:, action_dim], label="predicted action")
@@ -268,5 +379,5 @@ class OctoInference:
 
         axs["image"].imshow(img_strip)
         axs["image"].set_xlabel("Time in one episode (subsampled)")
-        plt.legend()
-        plt.savefig(save_path)
+        axs[ACTION_DIM_LABELS[-1]].legend()
+        fig.savefig(save_path, dpi=80)
@@ -1,4 +1,5 @@
 from base64 import b64decode, b64encode
+import functools
 from typing import Optional, Sequence, Any
 import json
 import time
@@ -7,9 +8,12 @@ import urllib
 import matplotlib.pyplot as plt
 import numpy as np
 from numpy.lib.format import descr_to_dtype, dtype_to_descr
+import orjson
 import requests
-import tensorflow as tf
-from transforms3d.euler import euler2axangle
+from requests.adapters import HTTPAdapter
+
+from simpler_env.utils.action.rotation import euler2axangle_fast
+from simpler_env.utils.image_resize import ImageResizer
 
 
 def default(obj):
@@ -75,6 +79,8 @@ class OctoServerInference:
         policy_setup: str = "widowx_bridge",
         image_size: str = 256,
         action_scale: float = 1.0,
+        tf_compatible_resize: bool = True,
+        use_msgpack: bool = False,
     ) -> None:
         if policy_setup == "widowx_bridge":
             self.sticky_gripper_num_repeat = 1
@@ -86,6 +92,7 @@ class OctoServerInference:
         else:
             raise NotImplementedError(f"Policy setup {policy_setup} not supported for octo models.")
         self.policy_setup = policy_setup
+        self._is_google_robot = policy_setup == "google_robot"
 
         self.sticky_action_is_on = False
         self.gripper_action_repeat = 0
@@ -94,18 +101,28 @@ class OctoServerInference:
         self.previous_gripper_action = None
 
         self.image_size = image_size
+        self._resizer = ImageResizer(image_size, tf_compatible=tf_compatible_resize)
         self.action_scale = action_scale
         self.task = None
-
-    def _resize_image(self, image: np.ndarray) -> np.ndarray:
-        image = tf.image.resize(
-            image,
-            size=(self.image_size, self.image_size),
-            method="lanczos3",
-            antialias=True,
-        )
-        image = tf.cast(tf.clip_by_value(tf.round(image), 0, 255), tf.uint8).numpy()
-        return image
+        self._vis_fig, self._vis_axs = None, None
+
+        # reuse one keep-alive connection across steps instead of opening a new one per request
+        self._session = requests.Session()
+        self._session.mount("http://", HTTPAdapter(pool_maxsize=4))
+        self._query_url = urllib.parse.urljoin("http://ari.bair.berkeley.edu:8000", "query")
+        self._reset_url = urllib.parse.urljoin("http://ari.bair.berkeley.edu:8000", "reset")
+        # use_msgpack=True sends the query as a binary msgpack body instead of base64-encoded json; this avoids the 4/3
+        # base64 size inflation of the image, but requires a server that accepts application/msgpack
+        self.use_msgpack = use_msgpack
+        self._query_content_type = "application/msgpack" if use_msgpack else "application/json"
+        if use_msgpack:
+            # imported here, as msgpack and msgpack-numpy are optional dependencies; numpy arrays are packed as raw
+            # bytes by msgpack_numpy's hooks, passed explicitly instead of patching msgpack for the whole process
+            import msgpack
+            import msgpack_numpy
+
+            self._msgpack_packb = functools.partial(msgpack.packb, default=msgpack_numpy.encode, use_bin_type=True)
+            self._msgpack_unpackb = functools.partial(msgpack.unpackb, object_hook=msgpack_numpy.decode, raw=False)
 
     def reset(self, task_description: str) -> None:
         self.task = task_description
@@ -114,13 +131,10 @@ class OctoServerInference:
         self.sticky_gripper_action = 0.0
         # self.gripper_is_closed = False
         self.previous_gripper_action = None
-        _ = requests.post(
-            urllib.parse.urljoin("http://ari.bair.berkeley.edu:8000", "reset"),
-            timeout=100,
-        )
+        _ = self._session.post(self._reset_url, timeout=100)
         time.sleep(1.0)
 
-    def _get_fake_pay_load(self, image_primary: np.ndarray, text: str, modality: str = "l") -> dict:
+    def _get_fake_pay_load(self, image_primary: np.ndarray, text: str, modality: str = "l") -> bytes:
         payload = {
             "dataset_name": self.dataset_name,
             "observation": {
@@ -130,18 +144,26 @@ class OctoServerInference:
             "modality": modality,
             "ensemble": True,
         }
-        fake_pay_load = {"use_this": dumps(payload)}
+        if self.use_msgpack:
+            return self._msgpack_packb(payload)
+        # the server expects the json-encoded payload as a string under "use_this"; serialize the full request body
+        # with orjson, so the base64-encoded image goes through the C encoder instead of the stdlib json module
+        fake_pay_load = orjson.dumps({"use_this": orjson.dumps(payload, default=default).decode()})
         return fake_pay_load
 
     def _query_for_action(self, image_primary: np.ndarray, text: str, goal: Optional[Any], modality="l") -> list:
         del goal
         # _ = requests.post(urllib.parse.urljoin("http://ari.bair.berkeley.edu:8000", "reset"),)
         fake_pay_load = self._get_fake_pay_load(image_primary, text, modality)
-        reply = requests.post(
-            urllib.parse.urljoin("http://ari.bair.berkeley.edu:8000", "query"),
-            json=fake_pay_load,
+        reply = self._session.post(
+            self._query_url,
+            data=fake_pay_load,
+            headers={"Content-Type": self._query_content_type},
             timeout=100,
-        ).json()
+        )
+        if self.use_msgpack:
+            return self._msgpack_unpackb(reply.content)
+        reply = orjson.loads(reply.content)
         # print(reply)
         return loads(reply)
 
@@ -164,13 +186,14 @@ class OctoServerInference:
                 self.reset(task_description)
         
         assert image.dtype == np.uint8
-        image = self._resize_image(image)
+        image = self._resizer.resize(image)
 
-        raw_action = self._query_for_action(image, self.task, goal=None)
+        # the reply is decoded into a new array on every step, so the raw actions can be views into it
+        raw_action = np.asarray(self._query_for_action(image, self.task, goal=None), dtype=np.float64)
         raw_action = {
-            "world_vector": np.array(raw_action[:3]),
-            "rotation_delta": np.array(raw_action[3:6]),
-            "open_gripper": np.array(raw_action[-1:]),  # range [0, 1]; 1 = open; 0 = close
+            "world_vector": raw_action[:3],
+            "rotation_delta": raw_action[3:6],
+            "open_gripper": raw_action[-1:],  # range [0, 1]; 1 = open; 0 = close
         }
 
         # process raw_action to obtain the action to be sent to the maniskill2 environment
@@ -178,11 +201,11 @@ class OctoServerInference:
         action["world_vector"] = raw_action["world_vector"] * self.action_scale
         action_rotation_delta = np.asarray(raw_action["rotation_delta"], dtype=np.float64)
         roll, pitch, yaw = action_rotation_delta
-        action_rotation_ax, action_rotation_angle = euler2axangle(roll, pitch, yaw)
+        action_rotation_ax, action_rotation_angle = euler2axangle_fast(roll, pitch, yaw)
         action_rotation_axangle = action_rotation_ax * action_rotation_angle
         action["rot_axangle"] = action_rotation_axangle * self.action_scale
 
-        if self.policy_setup == "google_robot":
+        if self._is_google_robot:
             current_gripper_action = raw_action["open_gripper"]
 
             # This is one of the ways to implement gripper actions; we use an alternative implementation below for consistency with real
@@ -229,10 +252,9 @@ class OctoServerInference:
 
             action["gripper"] = relative_gripper_action
 
-        elif self.policy_setup == "widowx_bridge":
-            action["gripper"] = (
-                2.0 * (raw_action["open_gripper"] > 0.5) - 1.0
-            )  # binarize gripper action to 1 (open) and -1 (close)
+        else:
+            # binarize gripper action to 1 (open) and -1 (close)
+            action["gripper"] = np.array([1.0 if raw_action["open_gripper"][0] > 0.5 else -1.0])
             # self.gripper_is_closed = (action['gripper'] < 0.0)
 
         action["terminate_episode"] = np.array([0.0])
@@ -240,24 +262,29 @@ class OctoServerInference:
         return raw_action, action
 
     def visualize_epoch(self, predicted_raw_actions: Sequence[np.ndarray], images: Sequence[np.ndarray], save_path: str):
-        images = [self._resize_image(image) for image in images]
+        # only every third image is shown in the image strip
+        images = self._resizer.resize_batch(images[::3])
         ACTION_DIM_LABELS = ["x", "y", "z", "yaw", "pitch", "roll", "grasp"]
 
-        img_strip = np.concatenate(np.array(images[::3]), axis=1)
+        img_strip = np.concatenate(images, axis=1)
 
-        # set up plt figure
-        figure_layout = [["image"] * len(ACTION_DIM_LABELS), ACTION_DIM_LABELS]
-        plt.rcParams.update({"font.size": 12})
-        fig, axs = plt.subplot_mosaic(figure_layout)
-        fig.set_size_inches([45, 10])
+        # set up plt figure; it is created once and cleared on later calls, as this is called after every episode
+        if self._vis_fig is None:
+            figure_layout = [["image"] * len(ACTION_DIM_LABELS), ACTION_DIM_LABELS]
+            plt.rcParams.update({"font.size": 12})
+            self._vis_fig, self._vis_axs = plt.subplot_mosaic(figure_layout)
+            self._vis_fig.set_size_inches([45, 10])
+        else:
+            for ax in self._vis_axs.values():
+                ax.clear()
+        fig, axs = self._vis_fig, self._vis_axs
 
         # plot actions
-        pred_actions = np.array(
-            [
-                np.concatenate([a["world_vector"], a["rotation_delta"], a["open_gripper"]], axis=-1)
-                for a in predicted_raw_actions
-            ]
-        )
+        pred_actions = np.empty((len(predicted_raw_actions), len(ACTION_DIM_LABELS)), dtype=np.float32)
+        for i, a in enumerate(predicted_raw_actions):
+            pred_actions[i, :3] = a["world_vector"]
+            pred_actions[i, 3:6] = a["rotation_delta"]
+            pred_actions[i, 6:] = a["open_gripper"]
         for action_dim, action_label in enumerate(ACTION_DIM_LABELS):
             # actions have batch, horizon, dim, in this example we just take the first action for simplicity
             axs[action_label].plot(pred_actions[:, action_dim], label="predicted action")
@@ -266,5 +293,5 @@ class OctoServerInference:
 
         axs["image"].imshow(img_strip)
         axs["image"].set_xlabel("Time in one episode (subsampled)")
-        plt.legend()
-        plt.savefig(save_path)
+        axs[ACTION_DIM_LABELS[-1]].legend()
+        fig.savefig(save_path, dpi=80)
@@ -0,0 +1,28 @@
+import math
+
+import numpy as np
+
+_IDENTITY_THRESH = 3 * np.finfo(np.float64).eps
+
+
+def euler2axangle_fast(roll, pitch, yaw):
+    """
+    Same as transforms3d.euler.euler2axangle(roll, pitch, yaw) with the default static xyz axes, written out in
+    closed form with scalar math (euler -> quaternion -> axis-angle), as it is called on every policy step.
+    Also compiles under numba.
+    Output:
+        axis: np.ndarray of shape (3,), unit rotation axis; [1, 0, 0] for an identity rotation
+        angle: float, rotation angle in radians
+    """
+    cr, sr = math.cos(roll / 2.0), math.sin(roll / 2.0)
+    cp, sp = math.cos(pitch / 2.0), math.sin(pitch / 2.0)
+    cy, sy = math.cos(yaw / 2.0), math.sin(yaw / 2.0)
+    qw = cr * cp * cy + sr * sp * sy
+    qx = sr * cp * cy - cr * sp * sy
+    qy = cr * sp * cy + sr * cp * sy
+    qz = cr * cp * sy - sr * sp * cy
+    sin_half_angle = math.sqrt(qx * qx + qy * qy + qz * qz)
+    if sin_half_angle < _IDENTITY_THRESH:
+        return np.array([1.0, 0.0, 0.0]), 0.0
+    angle = 2.0 * math.atan2(sin_half_angle, qw)
+    return np.array([qx, qy, qz]) / sin_half_angle, angle
@@ -0,0 +1,171 @@
+"""
+Lanczos3 image resizing that approximates tf.image.resize(method="lanczos3", antialias=True) without tensorflow.
+
+The resampling weights follow tensorflow's formulation, but the float32 accumulation order differs, so after
+rounding to uint8 a small fraction of pixels (up to ~0.15%, for both downscaling and upscaling) differ from tf by
++-1 intensity level; the result is not bit-exact.
+
+The resize is separable, so for a fixed (input_size, output_size) pair each axis reduces to multiplying by a
+constant sparse resampling matrix. Every output pixel only depends on a short contiguous span of input pixels,
+so the matrix is stored as the first input index of each span plus the (output_size, span_size) span weights.
+The weights only depend on the image shapes and can be built once and reused for every frame of a rollout;
+the resize itself is a numba kernel that runs in parallel over output rows. ImageResizer wraps it for the policies,
+with Pillow's lanczos resize as an opt-in alternative.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Sequence
+import math
+import threading
+
+from numba import njit, prange
+import numpy as np
+from PIL import Image
+
+LANCZOS3_RADIUS = 3.0
+
+# numba's default threading layer does not support parallel kernels being launched from several python threads at
+# once; the policies in this repo only resize from the calling thread, but external callers may resize from threads
+_kernel_lock = threading.Lock()
+
+
+def _lanczos3_kernel(x: np.ndarray) -> np.ndarray:
+    # same float32 formulation as tensorflow's LanczosKernelFunc, including the sin(x) / x limit at 0
+    x = np.abs(x)
+    pi = np.float32(3.14159265359)
+    radius = np.float32(LANCZOS3_RADIUS)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        weight = radius * np.sin(pi * x) * np.sin(pi * x / radius) / (pi * pi * x * x)
+    weight = np.where(x <= 1e-3, np.float32(1.0), weight)
+    return np.where(x > radius, np.float32(0.0), weight).astype(np.float32)
+
+
+def lanczos3_resize_weights(input_size: int, output_size: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Build the sparse resampling matrix of tensorflow's antialiased lanczos3 resize along a single axis
+    (see ComputeSpansCore in tensorflow/core/kernels/image/scale_and_translate_op.cc).
+    Output:
+        starts: np.ndarray of shape (output_size,), int64; first input pixel of the span read by each output pixel
+        weights: np.ndarray of shape (output_size, span_size), float32; weights of the input pixels in each span
+    """
+    inv_scale = np.float32(input_size) / np.float32(output_size)
+    kernel_scale = max(inv_scale, np.float32(1.0))
+    kernel_extent = np.float32(LANCZOS3_RADIUS) * kernel_scale
+    span_size = min(2 * math.ceil(LANCZOS3_RADIUS * kernel_scale) + 1, input_size)
+
+    starts = np.zeros(output_size, dtype=np.int64)
+    weights = np.zeros((output_size, span_size), dtype=np.float32)
+    for x in range(output_size):
+        sample_f = (np.float32(x) + np.float32(0.5)) * inv_scale
+        span_start = int(np.clip(np.ceil(sample_f - kernel_extent - np.float32(0.5)), 0, input_size - 1))
+        span_end = int(np.clip(np.floor(sample_f + kernel_extent - np.float32(0.5)), 0, input_size - 1)) + 1
+        sources = np.arange(span_start, span_end, dtype=np.float32)
+        span_weights = _lanczos3_kernel((sources + np.float32(0.5) - sample_f) / kernel_scale)
+        total_weight = span_weights.sum(dtype=np.float32)
+        if np.abs(total_weight) >= 1000.0 * np.finfo(np.float32).tiny:
+            span_weights = span_weights * (np.float32(1.0) / total_weight)
+        # keep every span fully inside the image; the unused taps get a zero weight
+        starts[x] = min(span_start, input_size - span_size)
+        offset = span_start - starts[x]
+        weights[x, offset : offset + len(span_weights)] = span_weights
+    return starts, weights
+
+
+@njit(parallel=True, fastmath=True, cache=True, nogil=True)
+def _lanczos3_resize_kernel(images, out, starts_y, weights_y, starts_x, weights_x, quantize):
+    # images: (N, H, W * C), out: (N, out_H, out_W, C); one parallel task per output row of each image
+    num_images, out_h, out_w, channels = out.shape
+    row_size = images.shape[2]
+    for task in prange(num_images * out_h):
+        n, i = task // out_h, task % out_h
+        # resample along H, giving one (W * C) row
+        row = np.zeros(row_size, dtype=np.float32)
+        for t in range(weights_y.shape[1]):
+            weight = weights_y[i, t]
+            src = images[n, starts_y[i] + t]
+            for k in range(row_size):
+                row[k] += weight * np.float32(src[k])
+        # resample the row along W
+        for j in range(out_w):
+            offset = starts_x[j] * channels
+            for c in range(channels):
+                value = np.float32(0.0)
+                for t in range(weights_x.shape[1]):
+                    value += weights_x[j, t] * row[offset + t * channels + c]
+                if quantize:
+                    out[n, i, j, c] = min(max(round(value), 0), 255)
+                else:
+                    out[n, i, j, c] = value
+
+
+def lanczos3_resize(
+    image: np.ndarray,
+    resize_weights_y: tuple[np.ndarray, np.ndarray],
+    resize_weights_x: tuple[np.ndarray, np.ndarray],
+    quantize: bool = True,
+) -> np.ndarray:
+    """
+    Input:
+        image: np.ndarray of shape (..., H, W, C); leading batch dimensions are resized in the same call
+        resize_weights_y, resize_weights_x: (starts, weights) for the H and W axes, from lanczos3_resize_weights
+        quantize: whether to round and clip the result to uint8 the same way as the tf resize path
+    Output:
+        np.ndarray of shape (..., out_H, out_W, C); uint8 if quantize, otherwise the unrounded float32 result
+    """
+    starts_y, weights_y = resize_weights_y
+    starts_x, weights_x = resize_weights_x
+    batch_shape, (in_h, in_w, channels) = image.shape[:-3], image.shape[-3:]
+    images = np.ascontiguousarray(image).reshape(-1, in_h, in_w * channels)
+    out = np.empty(
+        (images.shape[0], len(starts_y), len(starts_x), channels), dtype=np.uint8 if quantize else np.float32
+    )
+    with _kernel_lock:
+        _lanczos3_resize_kernel(images, out, starts_y, weights_y, starts_x, weights_x, quantize)
+    return out.reshape(*batch_shape, *out.shape[1:])
+
+
+class ImageResizer:
+    """
+    Resize images to (size, size) for a policy. By default (tf_compatible=True) this uses lanczos3_resize, which is
+    within +-1 intensity level of the tf.image.resize used by the octo training pipeline; its resampling weights are
+    built once per input image shape and cached. With tf_compatible=False, it uses Pillow's lanczos filter instead,
+    which is not identical to tf's: on the frames in images/example_visualization (512x640 -> 256x256), pixels differ
+    by up to 4-8 intensity levels (mean ~0.1 level per pixel).
+    """
+
+    def __init__(self, size: int, tf_compatible: bool = True) -> None:
+        self.size = size
+        self.tf_compatible = tf_compatible
+        self._pil_size = (size, size)  # Pillow (width, height) of resized images
+        self._weights_cache = {}  # (H, W) of input image -> lanczos3 resize weights along each axis
+
+    def _get_weights(self, image_hw: tuple[int, int]) -> tuple[tuple[np.ndarray, np.ndarray], ...]:
+        resize_weights = self._weights_cache.get(image_hw)
+        if resize_weights is None:
+            resize_weights = (
+                lanczos3_resize_weights(image_hw[0], self.size),
+                lanczos3_resize_weights(image_hw[1], self.size),
+            )
+            self._weights_cache[image_hw] = resize_weights
+        return resize_weights
+
+    def resize(self, image: np.ndarray, quantize: bool = True) -> np.ndarray:
+        """
+        Input:
+            image: np.ndarray of shape (H, W, 3), uint8
+            quantize: only used with tf_compatible=True; see lanczos3_resize
+        Output:
+            np.ndarray of shape (size, size, 3)
+        """
+        if not self.tf_compatible:
+            return np.asarray(Image.fromarray(image).resize(self._pil_size, Image.LANCZOS))
+        return lanczos3_resize(image, *self._get_weights(image.shape[:2]), quantize=quantize)
+
+    def resize_batch(self, images: Sequence[np.ndarray], quantize: bool = True) -> np.ndarray:
+        """Resize a sequence of same-shaped images, returning an np.ndarray of shape (N, size, size, 3)."""
+        if not self.tf_compatible:
+            # Pillow releases the GIL while resizing, so the images can be resized in parallel
+            with ThreadPoolExecutor() as executor:
+                return np.stack(list(executor.map(self.resize, images)), axis=0)
+        images = np.stack(images, axis=0)
+        return lanczos3_resize(images, *self._get_weights(images.shape[1:3]), quantize=quantize)